@@ -8,33 +8,41 @@
 # %%
 import os
 import subprocess
+import time
 
 from pathlib import Path
 from zipfile import ZipFile, ZIP_DEFLATED
-from datetime import datetime
 
 # %% [markdown]
 # Call the GIS Enterprise Reporter executable, with the `er.config` file as the first argument
 # - `er.config` contains the info needed to run the reports
+# - the reports take a while to run, so the reporter is started without waiting for it to finish
 
 # %%
-subprocess.run(["C:\Esri\gis_enterprise_reporter\gis_enterprise_reporter\er.exe", "C:\Esri\er.config"])
+proc = subprocess.Popen([r"C:\Esri\gis_enterprise_reporter\gis_enterprise_reporter\er.exe", r"C:\Esri\er.config"])
 
 # %% [markdown]
-# After the reports have run, create a ZIP file
+# While the reports run, set up the output location and date stamp
 
 # %%
 # use the same output directory in "C:\Esri\er.config"
 
 OutputDirectory = Path(r"C:\Esri\output")
 
-date_str = datetime.strftime(datetime.today(), r'%Y%m%d')  # 20250715
+date_str = time.strftime(r'%Y%m%d')  # 20250715
+
+# %% [markdown]
+# After the reports have run, create a ZIP file
+
+# %%
+# wait for GIS Enterprise Reporter to finish writing the reports
+proc.wait()
 
 # get the first filename in the output directory, for building the name if the ZIP archive
 for file in os.listdir(OutputDirectory):
 
     # skip any file that ends in .zip
-    if file[-4:] != ".zip":
+    if not file.endswith(".zip"):
         report = file
         break
 
@@ -43,26 +51,39 @@ report_words = report.split('_')  # split the filename into a list
 indx_portal = report_words.index('portal')  # find out where the word 'portal' is located (hint, it's 4)
 report_words = report_words[0:indx_portal+1]  # get the first 5 words in the filename (to include 'portal')
 report_words.append(date_str)  # append the date stamp to the list
-zipfile = '_'.join(report_words)
+zipfile = '_'.join(report_words)  # join all of the words into a string, separated by underscores
+
+# ex: "central_udot_utah_gov_portal_20250715"
 
 # build the full path and filename of the ZIP archive
 arch_zip = Path(OutputDirectory, zipfile).with_suffix(".zip")
 
+# ex: "C:\Esri\output\central_udot_utah_gov_portal_20250715.zip"
+
 # %% [markdown]
 # Add the output reports to the ZIP file and delete the originals
 
 # %%
+# ZIP compression level
+# level 9 is the slowest deflate setting, and the Excel reports are already compressed, so it barely makes the archive smaller than level 6
+# level 6 (the zlib default) is much faster for nearly the same size
+# levels 1-5 are faster still, but give up more space in the archive
+ZIP_LEVEL = 6
+
 # add files to the ZIP file
-with ZipFile(arch_zip, mode='w', compression=ZIP_DEFLATED, compresslevel=9) as outzip:
+with ZipFile(arch_zip, mode='w', compression=ZIP_DEFLATED, compresslevel=ZIP_LEVEL) as outzip:
 
-    for itemfile in Path(OutputDirectory).iterdir():
+    # skip any file that ends in .zip
+    reports = [p for p in OutputDirectory.iterdir() if p.suffix != ".zip"]
 
-        if str(itemfile)[-4:] != ".zip":
+    for itemfile in reports:
 
-            print(itemfile)
+        print(itemfile)
 
-            # add the file to the ZIP archive
-            outzip.write(itemfile, arcname=itemfile.name)
+        # add the file to the ZIP archive
+        outzip.write(itemfile, arcname=itemfile.name)
 
-            # delete the original file
-            itemfile.unlink()
+# delete the original files, once the ZIP archive has been written and closed
+# if zipping fails partway, the reports are still in the output folder
+for itemfile in reports:
+    itemfile.unlink()
@@ -31,13 +31,26 @@
 
 # %%
 import os
+import re
 import sys
+import queue
+import atexit
+import json
 import shutil
+import time
+import zipfile
 import logging
+import logging.handlers
 
 from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
-from datetime import datetime
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+# zipfile can only write Zstandard ZIP archives if this module is available
+# it was added in Python 3.14, and may still be missing if Python was built without the zstd library
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
 
 # %% [markdown]
 # ## Required User Inputs
@@ -46,10 +59,19 @@ from datetime import datetime
 # set the archive retention limit
 # this is the maximum number of zip files that will be retained
 # Note: this will always be the number of newest files, not necessarily the number of days that are retained
+# the zip files are numbered items_01.zip up to this limit, and each backup replaces the oldest one
 
 retention_limit = 15
 
 
+# %%
+# use Zstandard compression for the ZIP archives
+# Zstandard compresses the JSON files several times faster than deflate, for the same or a smaller archive
+# this needs Python 3.14 or newer (with Zstandard support). Otherwise deflate is always used
+# Note: Windows Explorer can't open Zstandard ZIP archives. Use 7-Zip or Python to restore files from them
+
+use_zstd = False
+
 # %%
 # set the logging level
 # this is the minimum logging level that will be retained in all log files and output streams
@@ -71,11 +93,10 @@ if not items_path.is_dir():
     sys.exit(1)
 
 # %%
-# Create names for timestamped folder and zip archive
+# Create name for timestamped zip archive
 
 # Archive folder location
-# temporarly folder containing copies of the JSON files are stored here
-# this folder is zipped, then deleted
+# the zip archives are stored here
 
 arch_path = Path(r"D:\Backups_portal_items")
 
@@ -84,14 +105,18 @@ if not arch_path.is_dir():
     sys.exit(1)
 
 
-arch_name = Path("items_" + datetime.strftime(datetime.today(), r'%Y_%m_%d_%H%M'))
-# ex: items_2025_06_27_1447
+# the zip archives rotate through a fixed set of numbered slots, items_01.zip up to the retention limit
+# the index file records the slot that was written last, and the date and time each slot was written
+# this way the retention limit is kept without listing or sorting the files in the archive folder
+# (the slot for this backup is picked from the index after the log file is set up, below)
 
-# new folder storing the copied JSON files (unzipped)
-arch_folder = Path(arch_path, arch_name)
+arch_index = Path(arch_path, "index.json")
 
-# filename of archived folder (zipped)
-arch_zip = Path(arch_path, arch_name).with_suffix(".zip")
+arch_time = time.strftime(r'%Y_%m_%d_%H%M')
+# ex: 2025_06_27_1447
+
+# link to the newest zip archive, for easy restores
+arch_latest = Path(arch_path, "items_latest.zip")
 
 
 # %% [markdown]
@@ -113,6 +138,7 @@ if not logfile.exists():
 # ## Log Handler setup
 #
 # There are two Handler objects created below. One will send log messages to the Log file. The other will display log messages to `stderr`
+# - log messages are passed to the handlers from a queue, by a background thread
 # - each handler has its own logging level defined, but the `log_level` set above is the absolute minimum for all handlers
 #   - i.e. to send `DEBUG` logs to the log file or `stderr`, the `log_level` must be changed to `DEBUG` above, and in the handlers below
 #
@@ -123,7 +149,7 @@ logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 
 # Set the format of the Log messages
-# ex:  Tue 2025-07-08 10:24:07 - INFO     creating ZIP archive: C:\test\Backups_portal_items\items_2025_07_08_1014.zip
+# ex:  Tue 2025-07-08 10:24:07 - INFO     creating ZIP archive: C:\test\Backups_portal_items\items_07.zip
 
 # Formatter
 fmt_str = "{asctime} - {levelname:<8} {message}"
@@ -147,151 +173,262 @@ log_handler_stream.setFormatter(log_formatter)
 
 
 # add the Handlers to the Logger object
-logger.addHandler(log_handler_file)
-logger.addHandler(log_handler_stream)
+# the Logger only puts each log message on a queue, and a background thread (the QueueListener) passes them to the Handlers
+# this way the backup doesn't wait for every message to be written to the log file
+log_queue = queue.SimpleQueue()
+
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+log_listener = logging.handlers.QueueListener(log_queue, log_handler_file, log_handler_stream, respect_handler_level=True)
+log_listener.start()
+
+# stop the listener when the script exits (even after an error), so every queued message still gets written
+atexit.register(log_listener.stop)
 
 
 # %% [markdown]
-# ## Create the archive folder for the daily backup
-# - this stores the copied JSON files
-# - this folder is later zipped to create the ZIP archive (and save space)
+# ## Pick the archive slot for this backup
+# - the slot that is empty, or holds the oldest archive, gets replaced
+# - if the index file is missing or can't be read, start over with an empty index
 
 # %%
-# check if the current output directory already exists in the backup folder location (it should not).
-# If not, create it
+empty_index = {"latest": 0, "slots": {}}
 
-if not arch_folder.is_dir():
-    try:
-        Path.mkdir(arch_folder)
+try:
+    with open(arch_index, encoding='UTF-8') as f:
+        index = json.load(f)
+
+    if not isinstance(index, dict) or not isinstance(index.get("slots"), dict):
+        raise ValueError("unexpected contents")
+
+except FileNotFoundError:
+    index = empty_index
 
-        # log the start time of the backup
-        logger.info("backup start")
+except ValueError as e:
+    logger.warning("unable to read %s (%s), starting a new index", arch_index, e)
+    index = empty_index
 
-        logger.info("archive folder created: " + str(arch_folder))
-    except:
-        logger.critical("unable to create archive folder")
+# pick the slot with the oldest date and time (the timestamps sort in chronological order)
+# empty slots sort first, and if there's a tie the lowest slot number wins
+arch_slot = min(range(1, retention_limit + 1), key=lambda slot: index["slots"].get(str(slot), ""))
 
+arch_name = Path(f"items_{arch_slot:02d}")
+# ex: items_07
+
+# filename of zip archive
+arch_zip = Path(arch_path, arch_name).with_suffix(".zip")
+
+# the new archive is written to a temporary file first, and only replaces the archive in the slot once it is complete
+arch_tmp = arch_zip.with_name(arch_zip.name + ".tmp")
 
 # %% [markdown]
 # ## Iterate through all files in the Portal Items Folder
 # - find the valid JSON configuration files
-# - copy those to the backup folder
+# - add those to the ZIP archive
 
 # %%
 # iterate through the current folders in the Portal Items folder
 # each folder is an Item ID for an Item in the Portal
 # some folders may be empty, others may have subfolders
 
-# copy the JSON files from each subfolder to the backup folder named with today's date and time
+# add the JSON files from each subfolder to the ZIP archive named with today's date and time
+# each file is read once, straight into the ZIP archive, without a temporary copy
+# Note: robocopy copies folder trees much faster than Python on Windows, but using it here would bring back the temporary copy,
+# and every file would be read twice (once by robocopy, once for the ZIP archive)
 
-def copy_json_files(items_path):
+# matches a filename that is exactly 32 hexadecimal digits
+# this only checks the characters, it doesn't convert the name to an integer or raise an exception for every other file
+is_uuid = re.compile(r'[0-9a-fA-F]{32}').fullmatch
 
-    copy_count = 0
 
-    for root, dirs, files in os.walk(items_path):
+def scan_files(path, top=True):
 
-        for file in files:  # returns filename string
+    # walk the folder tree with os.scandir, yielding a DirEntry for each file
+    # DirEntry objects cache the file type from the directory listing, so no extra stat is needed to tell files from folders
 
-            # json files for Portal Items are named with 32-character UUID strings
-            # we don't need to copy any other files (.xml, \esriinfo folder, or thumbnails, etc)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
 
-            # check if the filename is a valid UUID (string of 32 hexadecimal digits)
-            logger.debug("file: " + file)
+                # skip folders that never contain Item JSON files, without listing their contents:
+                # - \esriinfo folders and hidden folders
+                # - folders at the top of the Items folder that aren't named with an Item ID
+                if entry.name == 'esriinfo' or entry.name.startswith('.') or (top and not is_uuid(entry.name)):
+                    logger.debug("folder skipped: %s", entry.path)
+                    continue
 
-            if len(file) == 32:
-                try:
-                    # attempt to convert the filename string to an integer
-                    test_int = int(file, 16)
+                yield from scan_files(entry.path, top=False)
 
-                    # copy the file
-                    shutil.copy2(os.path.join(root,file), arch_folder)
-                    copy_count += 1
+            elif entry.is_file():
+                yield entry
 
-                    # set the specific file copied at the DEBUG level, or the logs fill up quickly.
-                    logger.debug(str(file) + " copied")
+            else:
+                # links to folders, broken links, and anything else that isn't a regular file
+                # a link to a folder is not followed, the same as os.walk
+                logger.debug("skipped, not a file: %s", entry.path)
 
-                except ValueError:
-                    # the file name is not a valid UUID, which means it's not the Item json we want to copy
 
-                    # pass
-                    logger.debug(str(file) + " not copied")
+def json_files(items_path):
 
-    logger.info("copied " + str(copy_count) + " JSON files to archive folder")
+    # yields the DirEntry for each Item JSON file in the Portal Items folder
 
-# %%
-# Run the function to copy the files...
+    for entry in scan_files(items_path):
 
-copy_json_files(items_path)
+        file = entry.name  # filename string
 
-# %% [markdown]
-# ## At this point:
-# - the current Portal Item JSON files have been copied from `items_path` to a backup folder `arch_folder`
-#
-# Next:
-# - zip and delete the folder of JSON files
-# - delete the oldest zip files to maintain the file retention limit setting
-#
-# Note: Zip archive file size seems to be about 40% of the unzipped folder size
+        # json files for Portal Items are named with 32-character UUID strings
+        # we don't need to archive any other files (.xml, \esriinfo folder, or thumbnails, etc)
 
-# %%
-# create the zip file and add files to it
-logger.info("creating ZIP archive: " + str(arch_zip))
+        # check if the filename is a valid UUID (string of 32 hexadecimal digits)
+        logger.debug("file: %s", file)
+
+        if is_uuid(file):
+            yield entry
+
+        else:
+            # the file name is not a valid UUID, which means it's not the Item json we want to copy
+            logger.debug("%s not archived", file)
 
-with ZipFile(arch_zip, mode='w', compression=ZIP_DEFLATED, compresslevel=9) as outzip:
 
-    logger.debug("opened ZIP file")
+# size of the buffer used to copy each JSON file into the ZIP archive (1 MB)
+COPY_BUFSIZE = 1024 * 1024
 
-    for itemfile in Path(arch_folder).iterdir():
+
+def archive_json_files(items_path, outzip):
+
+    archive_count = 0
+
+    # names already written to the ZIP archive
+    # the files are stored without their folders, so the same Item ID found twice in the Items folder would become
+    # two entries with the same name, which restore tools either prompt about or silently overwrite
+    # the archive keeps one entry per Item ID: the first file found is kept, and any later copies are skipped with a warning
+    archived_names = set()
+
+    for entry in json_files(items_path):
+
+        if entry.name in archived_names:
+            logger.warning("%s skipped, an Item JSON file with the same name is already in the ZIP archive", entry.path)
+            continue
 
         # write the Item JSON file to the zip archive
         # by default, this creates a series of subfolders inside the ZIP file, in the same structure as the original
         # this makes it diffcult to browse ZIP files and restore their content (x subfolders deep, etc)
-        # strip out the leading path of subfolders by specifying arcname=itemfile.name
+        # strip out the leading path of subfolders by specifying arcname=entry.name
 
-        outzip.write(itemfile, arcname=itemfile.name)
+        # build the ZipInfo from the DirEntry stat, the same way ZipInfo.from_file does
+        # on Windows the stat info comes with the directory listing, so this skips an os.stat call for each file
+        st = entry.stat()
+        zinfo = ZipInfo(entry.name, date_time=time.localtime(st.st_mtime)[:6])
+        zinfo.file_size = st.st_size
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
 
-        logger.debug(str(itemfile) + " added to ZIP archive")
+        # use the archive's compression settings, the same as ZipFile.write does
+        zinfo.compress_type = outzip.compression
 
-        # delete the original file
-        itemfile.unlink()
-        logger.debug(str(itemfile) + " deleted from archive folder")
+        # the compression level attribute is public as compress_level from Python 3.13 on
+        # older versions (like the 3.11 in ArcGIS Pro) only have the private _compresslevel
+        if hasattr(zinfo, 'compress_level'):
+            zinfo.compress_level = outzip.compresslevel
+        else:
+            zinfo._compresslevel = outzip.compresslevel
 
-    outzip.close()
-    logger.debug("closed ZIP file")
+        # ZipFile.write copies the file in 8 KB pieces; a larger buffer means fewer trips through the copy loop
+        # the source file is unbuffered, since copyfileobj already reads it in large pieces
+        with open(entry.path, 'rb', buffering=0) as src, outzip.open(zinfo, mode='w') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
 
-# remove the empty archive folder
-arch_folder.rmdir()
+        archived_names.add(entry.name)
+        archive_count += 1
 
-logger.info("archive folder deleted")
+        # set the specific file archived at the DEBUG level, or the logs fill up quickly.
+        logger.debug("%s added to ZIP archive", entry.name)
 
+    logger.info("added %d JSON files to ZIP archive", archive_count)
 
 # %% [markdown]
-# Remove the oldest archive(s) to maintain the retention limit
+# ## Create the ZIP archive
+# - the JSON files are written directly from `items_path` into the ZIP archive `arch_zip`
+# - then delete the oldest zip files to maintain the file retention limit setting
+#
+# Note: Zip archive file size seems to be about 40% of the unzipped folder size
 
 # %%
-# get a list of all zip files in the archive folder
+# ZIP compression method and level
+
+if use_zstd and zstd is not None:
+    # level 3 (the Zstandard default) is faster than deflate level 6, and the archive is still smaller
+    # the higher levels (up to 22) only make the archive a little smaller, and take much longer
+    ZIP_COMPRESSION = zipfile.ZIP_ZSTANDARD
+    ZIP_LEVEL = 3
+else:
+    # level 9 is the slowest deflate setting, and for JSON and text files it only makes the archive slightly smaller than level 6
+    # level 6 (the zlib default) is much faster for nearly the same size
+    # levels 1-5 are faster still, but give up more space in the archive
+    # Note: zipfile always deflates with the standard zlib module. A faster deflate library (libdeflate) can't be
+    # plugged into ZipFile. A faster compressor needs Python 3.14+ with use_zstd turned on above
+    ZIP_COMPRESSION = ZIP_DEFLATED
+    ZIP_LEVEL = 6
+
+# create the zip file and add the JSON files to it
+
+# log the start time of the backup
+logger.info("backup start")
+
+logger.info("creating ZIP archive: %s", arch_zip)
 
-filelist = list(arch_path.glob('*.zip'))
+try:
+    with ZipFile(arch_tmp, mode='w', compression=ZIP_COMPRESSION, compresslevel=ZIP_LEVEL) as outzip:
 
-logger.info(str(len(filelist)) + " existing ZIP files")
+        logger.debug("opened ZIP file")
+
+        archive_json_files(items_path, outzip)
+
+    logger.debug("closed ZIP file")
+
+    # the new archive is complete, replace the oldest archive with it
+    os.replace(arch_tmp, arch_zip)
+
+except Exception:
+    logger.exception("backup failed, %s was not changed", arch_zip)
+    raise
+
+finally:
+    # remove the incomplete archive if the backup failed partway
+    arch_tmp.unlink(missing_ok=True)
+
+
+# %% [markdown]
+# Update the index of archive slots
+# - writing to the oldest slot has already replaced the oldest archive, so there is nothing to delete to maintain the retention limit
+# - except when the retention limit was lowered since the last backup, then the slots above the new limit are removed
+
+# %%
+index["latest"] = arch_slot
+index["slots"][str(arch_slot)] = arch_time
 
-# Sort the filenames in ascending order
-# this is also chronological order, since filenames are based on date and time of archive
-filelist.sort()
+for slot in [slot for slot in index["slots"] if int(slot) > retention_limit]:
+    dropfile = Path(arch_path, f"items_{int(slot):02d}.zip")
+    dropfile.unlink(missing_ok=True)
+    del index["slots"][slot]
+    logger.info("%s removed to maintain retention limit of %d ZIP files", dropfile, retention_limit)
 
-if len(filelist) > retention_limit:
+# write the index to a temporary file first too, so a failed write doesn't leave a broken index
+arch_index_tmp = arch_index.with_name(arch_index.name + ".tmp")
 
-    # slice off a list of files to drop from the FRONT of the sorted list
-    # when sorted alphabetically, the oldest files are first
+with open(arch_index_tmp, mode='w', encoding='UTF-8') as f:
+    json.dump(index, f, indent=2)
 
-    dropfiles = filelist[:(len(filelist) - retention_limit)]
+os.replace(arch_index_tmp, arch_index)
 
-    logger.info(str(len(dropfiles)) + " removed to maintain retention limit of " + str(retention_limit) + " ZIP files")
+logger.info("ZIP archive %s stored in slot %d of %d", arch_time, arch_slot, retention_limit)
 
-    for file in dropfiles:
-        Path.unlink(file)
-        logger.debug(str(file) + " deleted")
+# point items_latest.zip at the new archive
+# creating a symbolic link on Windows needs the "Create symbolic links" privilege, so this is optional
+try:
+    arch_latest.unlink(missing_ok=True)
+    os.symlink(arch_zip.name, arch_latest)
+except OSError:
+    logger.warning("unable to link %s to %s", arch_latest, arch_zip)
 
 
 logger.info("backup complete")
-# logging.shutdown()  # this might not be needed when running as a script